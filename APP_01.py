@@ -1,32 +1,361 @@
 import streamlit as st
-import tempfile
+import hashlib
+import io
 import json
+import math
+import os
+import re
+import tempfile
+import numpy as np
 import pandas as pd
-from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 from openai import OpenAI
+from pydub import AudioSegment
 from geopy.geocoders import Nominatim
-from geopy.distance import geodesic
 import pgeocode
 import time
 import gspread
-from oauth2client.service_account import ServiceAccountCredentials
+from google.oauth2.service_account import Credentials
+
+
+# Back new string Series with Arrow so string kernels run vectorized
+pd.options.mode.string_storage = "pyarrow"
+
+
+# =======================================
+# MODULE CONSTANTS
+# =======================================
+# Compiled once at import so Streamlit reruns don't rebuild it. One
+# alternation covers "$4,000", "4000 per month" and "budget is 4000",
+# so a single scan of the transcript yields every budget candidate.
+_BUDGET_RE = re.compile(
+    r"\$\s*(?P<dollar>\d{1,3}(?:,\d{3})*(?:\.\d{2})?)"
+    r"|(?P<amount>\d{1,3}(?:,\d{3})*)\s*(?:dollars?|per\s*month|/month)"
+    r"|(?:budget|maximum|max|up to)\s*(?:is|of)?\s*\$?\s*(?P<limit>\d{1,3}(?:,\d{3})*)",
+    re.IGNORECASE,
+)
+
+# Care-level keywords -> "Type of Service" substring; only the first
+# matching entry fires, mirroring the old if/elif chain. Plain
+# substrings (regex=False in the filter) skip the regex engine for a
+# straight C-level scan
+_CARE_TO_SERVICE = {
+    ("assisted", "al", "enhanced"): "Assisted",
+    ("memory", "dementia"): "Memory",
+    ("independent", "il"): "Independent",
+}
+
+EXTRACTION_SYSTEM_PROMPT = """
+You are a JSON generator for senior living placement.
+You MUST output ONLY valid JSON with NO markdown, NO explanations, NO code blocks.
+
+EXTRACTION RULES:
+1. Extract the PATIENT's information (the person who needs care), NOT the contact person
+2. For "max_budget": Extract ANY mention of monthly cost, budget, or price limit
+   - Look for phrases like: "$X per month", "$X/month", "budget is $X", "maximum $X", "up to $X"
+   - IMPORTANT: Extract ONLY the number (e.g., if text says "$4,000 per month", extract: 4000)
+   - If multiple budgets mentioned, use the MAXIMUM value
+   - If no budget mentioned, use null
+3. For "care_level": Choose ONE from ["Independent Living", "Assisted Living", "Enhanced Assisted Living", "Memory Care"]
+   - "Enhanced" or "higher level" care = "Enhanced Assisted Living"
+4. For "enhanced": Extract "yes" ONLY if explicitly mentioned as requirement
+5. For "enriched": Extract "yes" ONLY if explicitly mentioned as requirement
+6. For "preferred_location": Extract ALL cities/towns mentioned as preferences (format: ["City, State"])
+7. For "move_in_window": Choose ONE from ["Immediate (0-1 months)", "Near-term (1-6 months)", "Flexible (6+ months)"]
+   - "discharges in X" or "moving in X" = timeframe
+8. For "mentally": Describe cognitive state (e.g., "sharp", "mild impairment", "moderate dementia")
+
+JSON STRUCTURE:
+{
+    "name_of_patient": "",
+    "age_of_patient": "",
+    "injury_or_reason": "",
+    "primary_contact_information": {
+        "name": "",
+        "phone_number": "",
+        "email": ""
+    },
+    "mentally": "",
+    "care_level": "",
+    "preferred_location": [],
+    "enhanced": "",
+    "enriched": "",
+    "move_in_window": "",
+    "max_budget": null,
+    "pet_friendly": "",
+    "tour_availability": [],
+    "other_keywords": {}
+}
+
+CRITICAL: For max_budget, extract ONLY the numeric value (e.g., 4000, not "$4,000" or "4000 per month")
+"""
+
+
+# =======================================
+# TRANSCRIPTION HELPER
+# =======================================
+# Whisper models audio in 30-second windows, so a long call can be split
+# client-side and transcribed concurrently with no accuracy cost — total
+# latency drops to roughly one chunk's round-trip.
+#
+# cache_data keys on the audio bytes plus an API-key fingerprint (the
+# client itself is excluded via the underscore prefix), so re-entering
+# Step 2 with the same file never re-uploads anything.
+_CHUNK_MS = 30 * 1000
+_MAX_PARALLEL_TRANSCRIPTIONS = 8
+
+
+@st.cache_data(show_spinner=False)
+def transcribe_audio(_client, audio_bytes: bytes, filename: str, api_key_fp: str) -> str:
+    def single_upload() -> str:
+        bio = io.BytesIO(audio_bytes)
+        bio.name = filename
+        return _client.audio.transcriptions.create(model="whisper-1", file=bio).text
+
+    try:
+        audio = AudioSegment.from_file(io.BytesIO(audio_bytes))
+    except Exception:
+        # Decoder unavailable (e.g. no ffmpeg) — fall back to one upload
+        audio = None
+
+    if audio is None or len(audio) <= 2 * _CHUNK_MS:
+        return single_upload()
+
+    # Export every chunk before touching the network: decoding can
+    # succeed without an mp3 encoder being present (WAV reads natively),
+    # in which case the whole file goes up as one request instead.
+    # Keeping export out of the pool also means API errors still
+    # propagate rather than silently re-uploading the full audio.
+    try:
+        buffers = []
+        for i in range(0, len(audio), _CHUNK_MS):
+            buf = io.BytesIO()
+            audio[i:i + _CHUNK_MS].export(buf, format="mp3", bitrate="64k")
+            buf.seek(0)
+            buf.name = f"chunk_{len(buffers)}.mp3"
+            buffers.append(buf)
+    except Exception:
+        return single_upload()
+
+    def transcribe_chunk(buf):
+        return _client.audio.transcriptions.create(model="whisper-1", file=buf).text
+
+    with ThreadPoolExecutor(max_workers=_MAX_PARALLEL_TRANSCRIPTIONS) as pool:
+        texts = list(pool.map(transcribe_chunk, buffers))
+    return " ".join(texts)
+
+
+# =======================================
+# OPENAI CLIENT
+# =======================================
+# One client (and its httpx connection pool) per API key for the whole
+# session, instead of a fresh TLS setup inside every step
+@st.cache_resource(show_spinner=False)
+def get_openai_client(api_key: str) -> OpenAI:
+    return OpenAI(api_key=api_key)
+
+
+def api_key_fingerprint(api_key: str) -> str:
+    # Short digest so cached results are scoped per key without the raw
+    # key ending up in any cache key
+    return hashlib.sha256(api_key.encode()).hexdigest()[:8]
+
+
+# =======================================
+# PREFERENCE EXTRACTION
+# =======================================
+# Extraction at temperature 0 is deterministic for a given transcript,
+# so the parsed result is cached on the transcript text; the rerun that
+# follows "Extract Preferences" (and any later back-navigation) costs
+# nothing. Returns the prefs dict plus the budget recovered by the
+# regex fallback, if the model missed it.
+@st.cache_data(show_spinner=False)
+def extract_preferences(_client, transcript: str, api_key_fp: str):
+    response = _client.chat.completions.create(
+        model="gpt-4o-mini",
+        response_format={"type": "json_object"},
+        temperature=0,
+        messages=[
+            {"role": "system", "content": EXTRACTION_SYSTEM_PROMPT},
+            {"role": "user", "content": f"""Extract structured information from this consultation call transcript.
+
+TRANSCRIPT:
+{transcript}
+
+IMPORTANT REMINDERS:
+- For max_budget: Look carefully for ANY mention of dollar amounts, monthly costs, or budget limits
+- Extract ONLY the numeric value (e.g., if "$4,000 per month" is mentioned, extract: 4000)
+- If multiple people or budgets are mentioned, extract the MAXIMUM value
+- Patient is the person RECEIVING care, not the family member calling
+
+Return ONLY valid JSON, no explanations."""},
+        ],
+    )
+
+    raw = response.choices[0].message.content
+    if not raw or raw.strip() == "":
+        raise ValueError("Empty response from GPT")
+
+    prefs = json.loads(raw)
+
+    # Post-processing: If budget is missing, try to extract with regex
+    regex_budget = None
+    if not prefs.get("max_budget") or prefs.get("max_budget") == "":
+        # Single pass over the transcript; whichever alternation branch
+        # matched carries the number
+        matches = [
+            m.group("dollar") or m.group("amount") or m.group("limit")
+            for m in _BUDGET_RE.finditer(transcript)
+        ]
+        if matches:
+            try:
+                regex_budget = int(max(float(m.replace(',', '')) for m in matches))
+                prefs["max_budget"] = regex_budget
+            except ValueError:
+                pass
+
+    return prefs, regex_budget
+
+
+# =======================================
+# EXPLANATION BATCHER
+# =======================================
+# The results page needs up to 15 explanations (top 5 per tier). Packing
+# every community into one JSON-mode request trades N round-trips for
+# one and sends the shared client context a single time instead of
+# re-embedding it in every prompt.
+def _community_line(key, row) -> str:
+    distance = (
+        f"{round(row.get('Distance_miles', 0), 1)}"
+        if pd.notna(row.get('Distance_miles')) else "N/A"
+    )
+    return (
+        f"{key}|{row.get('Type of Service', 'N/A')}"
+        f"|{row.get('Town', 'N/A')}, {row.get('State', 'N/A')}"
+        f"|${row.get('Monthly Fee', 'N/A')}|{distance} mi"
+        f"|P{row.get('Priority_Level', 'N/A')}"
+    )
+
+
+def generate_explanations(api_key: str, prefs: dict, rows: dict) -> dict:
+    if not rows:
+        return {}
+
+    table = "\n".join(_community_line(key, row) for key, row in rows.items())
+    prompt = f"""As a senior living placement advisor, write a 2-3 sentence reason why each community below is a good match for the client. Focus on care level match, location convenience, value proposition, and why its priority tier makes sense.
+
+Client Needs:
+- Care Level: {prefs.get('care_level', 'Not specified')}
+- Budget: ${prefs.get('max_budget', 'Not specified')}
+- Preferred Location: {prefs.get('preferred_location', 'Not specified')}
+- Special Requirements: Enhanced={prefs.get('enhanced', 'No')}, Enriched={prefs.get('enriched', 'No')}
+
+Communities (id|type|location|monthly fee|distance|priority tier; P1=contracted rates, P2=placement partner, P3=other):
+{table}
+
+Return ONLY JSON shaped as {{"explanations": [{{"id": "<id>", "reason": "<2-3 sentences>"}}]}} with one entry per community."""
+
+    try:
+        response = get_openai_client(api_key).chat.completions.create(
+            model="gpt-4o-mini",
+            response_format={"type": "json_object"},
+            messages=[{"role": "user", "content": prompt}],
+            temperature=0.5,
+            max_tokens=200 * len(rows)
+        )
+        parsed = json.loads(response.choices[0].message.content)
+        return {
+            str(item.get("id")): item.get("reason")
+            for item in parsed.get("explanations", [])
+            if item.get("reason")
+        }
+    except Exception:
+        return {}
+
+
+# =======================================
+# ZIP GEOCODER
+# =======================================
+# pgeocode parses its ~40k-row postal CSV on construction; cache the
+# instance so reruns reuse the loaded table
+@st.cache_resource(show_spinner=False)
+def get_pgeocode(country: str = "us") -> pgeocode.Nominatim:
+    return pgeocode.Nominatim(country)
+
+
+# =======================================
+# CITY GEOCODER
+# =======================================
+# Each unique preferred-location string hits Nominatim at most once per
+# day; with one to three cached queries per session no pacing sleep is
+# needed to stay inside the fair-use policy. Inputs that are plain ZIP
+# codes never leave the machine at all — pgeocode resolves them from
+# its bundled offline table.
+@st.cache_data(ttl=86400, show_spinner=False)
+def geocode_city(query: str):
+    zip_match = re.fullmatch(r"\d{5}", query.strip())
+    if zip_match:
+        info = get_pgeocode().query_postal_code(zip_match.group())
+        if pd.notna(info.latitude):
+            return (info.latitude, info.longitude)
+        return None
+    geo = Nominatim(user_agent="assisted_living").geocode(query)
+    return (geo.latitude, geo.longitude) if geo else None
 
 
 # =======================================
 # GOOGLE SHEET LOADER
 # =======================================
-def load_private_google_sheet(sheet_name: str, worksheet_name: str = None):
+# The community database rarely changes, so a parquet snapshot on local
+# disk also survives app restarts (st.cache_data only covers one process)
+_SHEET_SNAPSHOT_TTL = 3600  # seconds
+
+
+def _sheet_snapshot_path(sheet_name: str, worksheet_name: str) -> str:
+    safe = re.sub(r"\W+", "_", f"{sheet_name}_{worksheet_name or 'sheet1'}")
+    return os.path.join(tempfile.gettempdir(), f"{safe}.parquet")
+
+
+# google-auth keeps the signed bearer token for its full lifetime, and
+# caching the authorized client reuses its HTTP session across reruns
+@st.cache_resource(show_spinner=False)
+def get_gspread_client():
     scope = [
         "https://www.googleapis.com/auth/spreadsheets.readonly",
         "https://www.googleapis.com/auth/drive.readonly",
     ]
-    creds = ServiceAccountCredentials.from_json_keyfile_dict(
-        st.secrets["gcp_service_account"], scope
+    creds = Credentials.from_service_account_info(
+        st.secrets["gcp_service_account"], scopes=scope
     )
-    client = gspread.authorize(creds)
+    return gspread.authorize(creds)
+
+
+# Cached on the two name strings only (st.secrets is not hashable), so
+# reruns within the TTL reuse the parsed DataFrame instead of re-running
+# OAuth and the Sheets fetch every time the user enters Step 4.
+@st.cache_data(ttl=600, show_spinner=False)
+def load_private_google_sheet(sheet_name: str, worksheet_name: str = None):
+    snapshot = _sheet_snapshot_path(sheet_name, worksheet_name)
+    try:
+        if os.path.getmtime(snapshot) > time.time() - _SHEET_SNAPSHOT_TTL:
+            return pd.read_parquet(snapshot)
+    except (OSError, ValueError):
+        pass
+
+    client = get_gspread_client()
     sheet = client.open(sheet_name)
     ws = sheet.worksheet(worksheet_name) if worksheet_name else sheet.sheet1
-    return pd.DataFrame(ws.get_all_records())
+    # get_all_values is a single batched read; get_all_records re-reads
+    # the header row and builds one dict per row
+    rows = ws.get_all_values()
+    if not rows:
+        return pd.DataFrame()
+    df = pd.DataFrame(rows[1:], columns=rows[0])
+    try:
+        df.to_parquet(snapshot)
+    except Exception:
+        pass  # snapshot is best-effort; the fetch already succeeded
+    return df
 
 
 # =======================================
@@ -46,8 +375,11 @@ default_sessions = {
     "preferences": None,
     "results": None,
 }
-for k, v in default_sessions.items():
-    st.session_state.setdefault(k, v)
+# One membership check per rerun; the whole dict is merged only on the
+# first run of a session
+if "_initialized" not in st.session_state:
+    st.session_state.update(default_sessions)
+    st.session_state["_initialized"] = True
 
 with st.sidebar:
     st.header("⚙️ Configuration")
@@ -92,7 +424,7 @@ with st.sidebar:
 # =======================================
 # STEP 1 – UPLOAD AUDIO
 # =======================================
-if st.session_state.step == "upload":
+def step_upload():
     st.header("Step 1: Upload Audio File")
     st.markdown("📤 Upload a recording of the client consultation call")
 
@@ -112,7 +444,7 @@ if st.session_state.step == "upload":
 # =======================================
 # STEP 2 – TRANSCRIBE AUDIO
 # =======================================
-elif st.session_state.step == "transcribe":
+def step_transcribe():
     st.header("Step 2: Transcribe Audio")
     
     # Show uploaded file info
@@ -141,31 +473,23 @@ elif st.session_state.step == "transcribe":
             try:
                 status_text.text("🔄 Initializing OpenAI client...")
                 progress_bar.progress(10)
-                client = OpenAI(api_key=api_key)
+                client = get_openai_client(api_key)
                 
                 audio_file = st.session_state.audio_files
-                ext = audio_file.name.split('.')[-1]
 
                 status_text.text("📦 Preparing audio file...")
                 progress_bar.progress(30)
-                with tempfile.NamedTemporaryFile(delete=False, suffix=f".{ext}") as tmp:
-                    tmp.write(audio_file.getbuffer())
-                    fp = tmp.name
+                audio_bytes = bytes(audio_file.getbuffer())
 
                 status_text.text("🎤 Sending to Whisper API (this may take a minute)...")
                 progress_bar.progress(50)
-                
-                with open(fp, "rb") as f:
-                    transcript = client.audio.transcriptions.create(
-                        model="whisper-1",
-                        file=f
-                    )
 
-                status_text.text("🧹 Cleaning up temporary files...")
-                progress_bar.progress(90)
-                Path(fp).unlink()
+                transcription = transcribe_audio(
+                    client, audio_bytes, audio_file.name, api_key_fingerprint(api_key)
+                )
 
-                st.session_state.transcription = transcript.text
+                progress_bar.progress(90)
+                st.session_state.transcription = transcription
                 
                 progress_bar.progress(100)
                 status_text.empty()
@@ -184,7 +508,7 @@ elif st.session_state.step == "transcribe":
 # =======================================
 # STEP 3 – EXTRACT PREFERENCES
 # =======================================
-elif st.session_state.step == "preferences":
+def step_preferences():
     st.header("Step 3: Extract Client Preferences")
     
     # Show transcription
@@ -201,51 +525,50 @@ elif st.session_state.step == "preferences":
         # Add option to edit budget if missing or seems wrong
         st.markdown("---")
         st.subheader("🔧 Review & Adjust (Optional)")
-        
-        col1, col2 = st.columns(2)
-        
-        with col1:
-            current_budget = st.session_state.preferences.get("max_budget")
-            if not current_budget or current_budget == "" or current_budget == "NULL":
-                st.warning("⚠️ Budget not detected. Please enter manually if needed.")
-                current_budget = None
-            
-            new_budget = st.number_input(
-                "Monthly Budget ($)",
-                min_value=0,
-                max_value=50000,
-                value=int(current_budget) if current_budget else 0,
-                step=100,
-                help="Leave as 0 if no budget constraint"
-            )
-            
-            if new_budget > 0 and new_budget != current_budget:
-                if st.button("💾 Update Budget"):
-                    st.session_state.preferences["max_budget"] = new_budget
-                    st.success(f"✅ Budget updated to ${new_budget:,}/month")
-                    st.rerun()
-        
-        with col2:
-            current_care = st.session_state.preferences.get("care_level", "")
-            care_options = ["Independent Living", "Assisted Living", "Enhanced Assisted Living", "Memory Care"]
-            
-            if current_care and current_care in care_options:
-                default_idx = care_options.index(current_care)
-            else:
-                default_idx = 1  # Default to Assisted Living
-            
-            new_care = st.selectbox(
-                "Care Level",
-                options=care_options,
-                index=default_idx
-            )
-            
-            if new_care != current_care:
-                if st.button("💾 Update Care Level"):
-                    st.session_state.preferences["care_level"] = new_care
-                    st.success(f"✅ Care level updated to {new_care}")
-                    st.rerun()
-        
+
+        current_budget = st.session_state.preferences.get("max_budget")
+        if not current_budget or current_budget == "" or current_budget == "NULL":
+            st.warning("⚠️ Budget not detected. Please enter manually if needed.")
+            current_budget = None
+
+        current_care = st.session_state.preferences.get("care_level", "")
+        care_options = ["Independent Living", "Assisted Living", "Enhanced Assisted Living", "Memory Care"]
+        if current_care and current_care in care_options:
+            default_idx = care_options.index(current_care)
+        else:
+            default_idx = 1  # Default to Assisted Living
+
+        # Both edits accumulate inside the form and apply in one rerun,
+        # instead of one full rerun per per-widget update button
+        with st.form("prefs_review"):
+            col1, col2 = st.columns(2)
+
+            with col1:
+                new_budget = st.number_input(
+                    "Monthly Budget ($)",
+                    min_value=0,
+                    max_value=50000,
+                    value=int(current_budget) if current_budget else 0,
+                    step=100,
+                    help="Leave as 0 if no budget constraint"
+                )
+
+            with col2:
+                new_care = st.selectbox(
+                    "Care Level",
+                    options=care_options,
+                    index=default_idx
+                )
+
+            submitted = st.form_submit_button("💾 Update Preferences")
+
+        if submitted:
+            if new_budget > 0:
+                st.session_state.preferences["max_budget"] = new_budget
+            st.session_state.preferences["care_level"] = new_care
+            st.success("✅ Preferences updated")
+            st.rerun()
+
         st.markdown("---")
         
         if st.button("▶️ Continue to Community Ranking", type="primary"):
@@ -260,121 +583,25 @@ elif st.session_state.step == "preferences":
             try:
                 status_text.text("🤖 Initializing AI model...")
                 progress_bar.progress(20)
-                client = OpenAI(api_key=api_key)
-
-                system_prompt = """
-                You are a JSON generator for senior living placement.
-                You MUST output ONLY valid JSON with NO markdown, NO explanations, NO code blocks.
-
-                EXTRACTION RULES:
-                1. Extract the PATIENT's information (the person who needs care), NOT the contact person
-                2. For "max_budget": Extract ANY mention of monthly cost, budget, or price limit
-                   - Look for phrases like: "$X per month", "$X/month", "budget is $X", "maximum $X", "up to $X"
-                   - IMPORTANT: Extract ONLY the number (e.g., if text says "$4,000 per month", extract: 4000)
-                   - If multiple budgets mentioned, use the MAXIMUM value
-                   - If no budget mentioned, use null
-                3. For "care_level": Choose ONE from ["Independent Living", "Assisted Living", "Enhanced Assisted Living", "Memory Care"]
-                   - "Enhanced" or "higher level" care = "Enhanced Assisted Living"
-                4. For "enhanced": Extract "yes" ONLY if explicitly mentioned as requirement
-                5. For "enriched": Extract "yes" ONLY if explicitly mentioned as requirement
-                6. For "preferred_location": Extract ALL cities/towns mentioned as preferences (format: ["City, State"])
-                7. For "move_in_window": Choose ONE from ["Immediate (0-1 months)", "Near-term (1-6 months)", "Flexible (6+ months)"]
-                   - "discharges in X" or "moving in X" = timeframe
-                8. For "mentally": Describe cognitive state (e.g., "sharp", "mild impairment", "moderate dementia")
-
-                JSON STRUCTURE:
-                {
-                    "name_of_patient": "",
-                    "age_of_patient": "",
-                    "injury_or_reason": "",
-                    "primary_contact_information": {
-                        "name": "",
-                        "phone_number": "",
-                        "email": ""
-                    },
-                    "mentally": "",
-                    "care_level": "",
-                    "preferred_location": [],
-                    "enhanced": "",
-                    "enriched": "",
-                    "move_in_window": "",
-                    "max_budget": null,
-                    "pet_friendly": "",
-                    "tour_availability": [],
-                    "other_keywords": {}
-                }
-                
-                CRITICAL: For max_budget, extract ONLY the numeric value (e.g., 4000, not "$4,000" or "4000 per month")
-                """
+                client = get_openai_client(api_key)
 
                 status_text.text("🧠 Analyzing transcription and extracting preferences...")
                 progress_bar.progress(50)
-                
-                response = client.chat.completions.create(
-                    model="gpt-4o",
-                    messages=[
-                        {"role": "system", "content": system_prompt},
-                        {"role": "user", "content": f"""Extract structured information from this consultation call transcript.
 
-TRANSCRIPT:
-{st.session_state.transcription}
-
-IMPORTANT REMINDERS:
-- For max_budget: Look carefully for ANY mention of dollar amounts, monthly costs, or budget limits
-- Extract ONLY the numeric value (e.g., if "$4,000 per month" is mentioned, extract: 4000)
-- If multiple people or budgets are mentioned, extract the MAXIMUM value
-- Patient is the person RECEIVING care, not the family member calling
-
-Return ONLY valid JSON, no explanations."""},
-                    ],
+                prefs, regex_budget = extract_preferences(
+                    client,
+                    st.session_state.transcription,
+                    api_key_fingerprint(api_key),
                 )
+                if regex_budget:
+                    st.info(f"💡 Detected budget from transcript: ${regex_budget:,}/month")
 
-                status_text.text("📊 Processing AI response...")
-                progress_bar.progress(80)
-                
-                raw = response.choices[0].message.content
-                
-                # Clean response if it has markdown
-                if "```json" in raw:
-                    raw = raw.split("```json")[1].split("```")[0].strip()
-                elif "```" in raw:
-                    raw = raw.split("```")[1].split("```")[0].strip()
-
-                if not raw or raw.strip() == "":
-                    raise ValueError("Empty response from GPT")
-
-                prefs = json.loads(raw)
-                
-                # Post-processing: If budget is missing, try to extract with regex
-                if not prefs.get("max_budget") or prefs.get("max_budget") == "":
-                    import re
-                    # Look for patterns like "$4,000", "$4000", "4000 dollars", etc.
-                    budget_patterns = [
-                        r'\$\s*(\d{1,3}(?:,\d{3})*(?:\.\d{2})?)',  # $4,000 or $4000.00
-                        r'(\d{1,3}(?:,\d{3})*)\s*(?:dollars?|per\s*month|/month)',  # 4000 dollars
-                        r'(?:budget|maximum|max|up to)\s*(?:is|of)?\s*\$?\s*(\d{1,3}(?:,\d{3})*)',  # budget is $4000
-                    ]
-                    
-                    transcript_lower = st.session_state.transcription.lower()
-                    for pattern in budget_patterns:
-                        matches = re.findall(pattern, st.session_state.transcription, re.IGNORECASE)
-                        if matches:
-                            # Extract all numbers, remove commas, and take the maximum
-                            try:
-                                budget_values = [float(m.replace(',', '')) for m in matches]
-                                max_budget = max(budget_values)
-                                prefs["max_budget"] = int(max_budget)
-                                st.info(f"💡 Detected budget from transcript: ${int(max_budget):,}/month")
-                                break
-                            except:
-                                pass
-                
                 st.session_state.preferences = prefs
-                
+
                 progress_bar.progress(100)
                 status_text.empty()
                 progress_bar.empty()
-                
+
                 st.success("✅ Preferences extracted!")
                 st.rerun()
 
@@ -382,15 +609,12 @@ Return ONLY valid JSON, no explanations."""},
                 status_text.empty()
                 progress_bar.empty()
                 st.error(f"❌ Preference Extraction Error: {e}")
-                if 'raw' in locals():
-                    with st.expander("🔍 Debug: Raw AI Response"):
-                        st.code(raw)
 
 
 # =======================================
 # STEP 4 – FILTERING & RANKING
 # =======================================
-elif st.session_state.step == "rank":
+def step_rank():
     st.header("Step 4: Rank & Filter Communities")
     
     # Show previous results
@@ -444,6 +668,25 @@ elif st.session_state.step == "rank":
                     initial_count = len(df)
                     st.info(f"📊 Loaded {initial_count} communities from database")
 
+                    # Project down to the columns the pipeline actually reads
+                    # (plus whichever column carries the ZIP) so every later
+                    # pass moves a narrow row instead of the full sheet width
+                    needed = [
+                        "Type of Service", "Town", "State", "Monthly Fee",
+                        "Apartment Type", "Enhanced", "Enriched",
+                        "Contract (w rate)?", "Work with Placement?",
+                        "Est. Waitlist Length", "CommunityID",
+                    ]
+                    needed += [c for c in df.columns if "zip" in c.lower()]
+                    df = df[[c for c in needed if c in df.columns]].copy()
+
+                    # Low-cardinality text as categoricals: filters compare int8
+                    # codes and regexes run once per unique value, not per row
+                    for col in ["Type of Service", "Enhanced", "Enriched",
+                                "Contract (w rate)?", "Work with Placement?"]:
+                        if col in df.columns:
+                            df[col] = df[col].astype("category")
+
                     # ---------- FIX BUDGET ----------
                     status_text.text("💰 Processing budget information...")
                     progress_bar.progress(20)
@@ -455,32 +698,30 @@ elif st.session_state.step == "rank":
 
                     # ---------- CLEAN MONTHLY FEE ----------
                     if "Monthly Fee" in df.columns:
-                        df["Monthly Fee"] = (
+                        # One replace + one extract instead of three chained
+                        # string passes; Arrow-backed strings run the regex as
+                        # vectorized kernels, and float32 halves the bandwidth
+                        # of the downstream filter/mean/sort passes
+                        df["Monthly Fee"] = pd.to_numeric(
                             df["Monthly Fee"]
-                            .astype(str)
-                            .str.replace("$", "", regex=False)
-                            .str.replace(",", "", regex=False)
-                            .str.extract(r"(\d+\.?\d*)")[0]
-                        )
-                        df["Monthly Fee"] = pd.to_numeric(df["Monthly Fee"], errors="coerce")
+                            .astype("string[pyarrow]")
+                            .str.replace(r"[$,]", "", regex=True)
+                            .str.extract(r"(\d+\.?\d*)", expand=False),
+                            errors="coerce",
+                        ).astype("float32")
 
                     # ---------- SMART CARE LEVEL ----------
                     status_text.text("🏥 Filtering by care level...")
                     progress_bar.progress(30)
                     if prefs.get("care_level"):
                         text = str(prefs["care_level"]).lower()
-
-                        if any(k in text for k in ["assisted", "al", "enhanced"]):
-                            df = df[df["Type of Service"].str.contains("Assisted", case=False, na=False)]
-                            st.info(f"✓ After care level filter: {len(df)} communities")
-
-                        elif any(k in text for k in ["memory", "dementia"]):
-                            df = df[df["Type of Service"].str.contains("Memory", case=False, na=False)]
-                            st.info(f"✓ After care level filter: {len(df)} communities")
-
-                        elif any(k in text for k in ["independent", "il"]):
-                            df = df[df["Type of Service"].str.contains("Independent", case=False, na=False)]
-                            st.info(f"✓ After care level filter: {len(df)} communities")
+                        for keywords, category in _CARE_TO_SERVICE.items():
+                            if any(k in text for k in keywords):
+                                df = df[df["Type of Service"].str.contains(
+                                    category, case=False, na=False, regex=False
+                                )]
+                                st.info(f"✓ After care level filter: {len(df)} communities")
+                                break
 
                     # ---------- ENHANCED ----------
                     status_text.text("⭐ Applying enhanced/enriched filters...")
@@ -502,23 +743,19 @@ elif st.session_state.step == "rank":
                     # ---------- PRIORITY ----------
                     status_text.text("🎯 Assigning priority levels...")
                     progress_bar.progress(50)
-                    def assign_priority(row):
-                        c = str(row.get("Contract (w rate)?", "")).lower()
-                        p = str(row.get("Work with Placement?", "")).lower()
-                        if c not in ["no", "nan", ""]:
-                            return 1
-                        if c == "no" and p == "yes":
-                            return 2
-                        return 3
-
-                    df["Priority_Level"] = df.apply(assign_priority, axis=1)
+                    # Vectorized: two lowered string columns and nested np.where
+                    # instead of a Python callback per row
+                    c = df.get("Contract (w rate)?", pd.Series("", index=df.index)).astype(str).str.lower()
+                    p = df.get("Work with Placement?", pd.Series("", index=df.index)).astype(str).str.lower()
+                    df["Priority_Level"] = np.where(
+                        ~c.isin(["no", "nan", ""]), 1,
+                        np.where((c == "no") & (p == "yes"), 2, 3),
+                    )
 
                     # ---------- GEOCODING ----------
                     status_text.text("🗺️ Calculating distances (this may take a moment)...")
                     progress_bar.progress(60)
                     
-                    geolocator = Nominatim(user_agent="assisted_living")
-
                     locs = prefs.get("preferred_location", ["Rochester, NY"])
                     if isinstance(locs, str):
                         locs = [locs]
@@ -526,10 +763,9 @@ elif st.session_state.step == "rank":
                     coords_list = []
                     for l in locs:
                         try:
-                            geo = geolocator.geocode(l)
-                            if geo:
-                                coords_list.append((geo.latitude, geo.longitude))
-                            time.sleep(1)
+                            coord = geocode_city(l)
+                            if coord:
+                                coords_list.append(coord)
                         except:
                             pass
 
@@ -539,55 +775,74 @@ elif st.session_state.step == "rank":
                     progress_bar.progress(70)
                     zip_col = next((c for c in df.columns if "zip" in c.lower()), None)
 
-                    def get_coord(row):
-                        if zip_col:
-                            z = row.get(zip_col)
-                            if pd.notna(z):
-                                try:
-                                    loc = geolocator.geocode(f"{int(float(z)):05d}, NY")
-                                    time.sleep(1)
-                                    if loc:
-                                        return (loc.latitude, loc.longitude)
-                                except:
-                                    pass
-                        return None
+                    # ---------- LOCATION PRE-FILTER ----------
+                    # Push the location predicate ahead of geocoding: keep only
+                    # communities sharing an SCF prefix (first three ZIP digits)
+                    # with a preferred city, so downstream stages see K ≪ N rows.
+                    if zip_col and prefs.get("preferred_location"):
+                        allowed_zip3 = set()
+                        for l in locs:
+                            try:
+                                hits = get_pgeocode().query_location(str(l).split(",")[0].strip())
+                                allowed_zip3.update(hits["postal_code"].astype(str).str[:3])
+                            except Exception:
+                                pass
+                        if allowed_zip3:
+                            zip3 = df[zip_col].apply(
+                                lambda z: str(int(float(z))).zfill(5)[:3]
+                                if str(z).strip().replace(".", "", 1).isdigit() else ""
+                            )
+                            mask = zip3.isin(allowed_zip3)
+                            # Only narrow when the prefix actually matches data,
+                            # so an out-of-region request still ranks by distance
+                            if mask.any():
+                                df = df[mask]
+                                st.info(f"✓ After location pre-filter: {len(df)} communities")
 
                     status_text.text("📍 Geocoding communities...")
                     progress_bar.progress(80)
-                    df["Community_Coords"] = df.apply(get_coord, axis=1)
-
-                    def dist(c):
-                        if c is None:
-                            return None
-                        try:
-                            return min(geodesic(c, k).miles for k in coords_list)
-                        except:
-                            return None
-
-                    df["Distance_miles"] = df["Community_Coords"].apply(dist)
 
-                    # Add Town/State
+                    # Batch ZIP lookup: pgeocode resolves all rows from a local
+                    # table in one call instead of one Nominatim request per row.
+                    # Lat/lon live as two float64 columns rather than a column
+                    # of Python tuples, feeding straight into the haversine.
                     if zip_col:
-                        nomi = pgeocode.Nominatim('us')
-                        df["Town"] = df[zip_col].apply(
-                            lambda z: nomi.query_postal_code(str(int(float(z))).zfill(5)).place_name if pd.notna(z) else None
-                        )
-                        df["State"] = df[zip_col].apply(
-                            lambda z: nomi.query_postal_code(str(int(float(z))).zfill(5)).state_code if pd.notna(z) else None
+                        zips = df[zip_col].apply(
+                            lambda z: str(int(float(z))).zfill(5)
+                            if str(z).strip().replace(".", "", 1).isdigit() else ""
                         )
+                        geo_df = get_pgeocode().query_postal_code(zips.tolist())
+                        df["Latitude"] = geo_df["latitude"].to_numpy(dtype=float)
+                        df["Longitude"] = geo_df["longitude"].to_numpy(dtype=float)
+                        df["Town"] = geo_df["place_name"].values
+                        df["State"] = geo_df["state_code"].values
+                    else:
+                        df["Latitude"] = np.nan
+                        df["Longitude"] = np.nan
+
+                    # Vectorized haversine: one NumPy pass over all rows replaces
+                    # per-row geodesic calls (NaN coords propagate to NaN distance)
+                    lat = np.radians(df["Latitude"].to_numpy(dtype=float))[:, None]
+                    lon = np.radians(df["Longitude"].to_numpy(dtype=float))[:, None]
+                    plat, plon = np.radians(np.array(coords_list, dtype=float)).T
+                    dlat = lat - plat[None, :]
+                    dlon = lon - plon[None, :]
+                    a = np.sin(dlat / 2) ** 2 + np.cos(lat) * np.cos(plat[None, :]) * np.sin(dlon / 2) ** 2
+                    miles = 2 * 3958.8 * np.arcsin(np.sqrt(a))
+                    df["Distance_miles"] = miles.min(axis=1)
 
                     status_text.text("📊 Sorting results by priority tiers and distance...")
                     progress_bar.progress(95)
                     
-                    # Sort by Priority first, then Distance within each priority
-                    df = df.sort_values(
-                        by=["Priority_Level", "Distance_miles"], 
-                        ascending=[True, True],
-                        na_position='last'
-                    )
-                    
-                    # Add a rank within each priority level
-                    df['Rank_Within_Priority'] = df.groupby('Priority_Level').cumcount() + 1
+                    # One stable lexsort by (priority, distance) — NaN distances
+                    # land last within their tier — then an O(N) cumcount on the
+                    # already-sorted keys for the within-tier rank
+                    order = np.lexsort((
+                        df["Distance_miles"].to_numpy(dtype=float),
+                        df["Priority_Level"].to_numpy(),
+                    ))
+                    df = df.iloc[order].reset_index(drop=True)
+                    df["Rank_Within_Priority"] = df.groupby("Priority_Level", sort=False).cumcount() + 1
 
                     st.session_state.results = df
                     
@@ -611,7 +866,79 @@ elif st.session_state.step == "rank":
 # =======================================
 # STEP 5 – RESULTS WITH AI EXPLANATIONS
 # =======================================
-elif st.session_state.step == "results":
+# CSV blobs are rebuilt on every rerun otherwise, clicked or not; cache
+# them on the frame contents so serialization happens once per result set
+@st.cache_data(show_spinner=False)
+def to_csv_bytes(df: pd.DataFrame, cols: tuple = ()) -> bytes:
+    out = df[list(cols)] if cols else df
+    return out.to_csv(index=False).encode()
+
+
+# Rendered as a fragment: interacting with one community card reruns
+# only that card, not the whole results page.
+@st.fragment
+def render_community(row, prefs, priority_level, idx, cache_key):
+    distance_text = f"{round(row['Distance_miles'], 1)} mi" if pd.notna(row.get('Distance_miles')) else "N/A"
+    expander_label = f"P{priority_level}-{idx}. {row.get('Type of Service', 'N/A')} | {distance_text} | {row.get('Town', 'N/A')}"
+
+    with st.expander(expander_label, expanded=(priority_level == 1 and idx <= 2)):
+        col1, col2 = st.columns([2, 1])
+
+        with col1:
+            st.markdown(f"### 📍 Location & Details")
+            town_val = row.get('Town', 'N/A')
+            state_val = row.get('State', 'N/A')
+            st.write(f"**Town:** {town_val}, {state_val}")
+
+            if pd.notna(row.get('Distance_miles')):
+                st.write(f"**Distance:** {round(row['Distance_miles'], 1)} miles from preferred location")
+            st.write(f"**Service Type:** {row.get('Type of Service', 'N/A')}")
+            st.write(f"**Apartment Type:** {row.get('Apartment Type', 'N/A')}")
+
+        with col2:
+            st.markdown(f"### 💰 Pricing")
+            if pd.notna(row.get('Monthly Fee')):
+                st.metric("Monthly Fee", f"${int(row['Monthly Fee']):,}")
+            else:
+                st.metric("Monthly Fee", "Contact for pricing")
+            st.metric("Priority Tier", f"Level {int(row.get('Priority_Level', 0))}")
+            st.metric("Rank in Tier", f"#{int(row.get('Rank_Within_Priority', 0))}")
+
+        # AI Explanation - only the expanders open by default are
+        # pre-filled; collapsed cards generate on demand behind a
+        # button, so they never spend an OpenAI call unless opened.
+        # The button click reruns just this fragment, not the page.
+        if api_key and api_key.startswith("sk-"):
+            explanation = st.session_state.get(cache_key)
+            if explanation:
+                st.info(f"**🎯 Why This Community Matches:** {explanation}")
+            elif st.button("🎯 Explain this match", key=f"btn_{cache_key}"):
+                with st.spinner("🤖 Generating explanation..."):
+                    fresh = generate_explanations(api_key, prefs, {"this": row})
+                text = fresh.get("this")
+                if text:
+                    st.session_state[cache_key] = text
+                    st.info(f"**🎯 Why This Community Matches:** {text}")
+                else:
+                    st.warning("⚠️ Could not generate AI explanation")
+        elif not api_key:
+            st.info("💡 Enter your OpenAI API key in the sidebar to see AI-powered match explanations")
+
+        # More Details - NOT nested, just in the same expander
+        st.markdown("---")
+        st.markdown("#### 📋 Additional Details")
+        details_col1, details_col2 = st.columns(2)
+        with details_col1:
+            st.write(f"**Enhanced:** {row.get('Enhanced', 'N/A')}")
+            st.write(f"**Enriched:** {row.get('Enriched', 'N/A')}")
+            st.write(f"**Contract Status:** {row.get('Contract (w rate)?', 'N/A')}")
+        with details_col2:
+            st.write(f"**Works with Placement:** {row.get('Work with Placement?', 'N/A')}")
+            st.write(f"**Est. Waitlist:** {row.get('Est. Waitlist Length', 'N/A')}")
+            st.write(f"**Community ID:** {row.get('CommunityID', 'N/A')}")
+
+
+def step_results():
     st.header("🏆 Step 5: Top Recommendations")
 
     df = st.session_state.results
@@ -665,10 +992,42 @@ elif st.session_state.step == "results":
         3: "🥉 Priority 3 - Other Communities"
     }
     
+    # One grouped pass supplies the per-tier frames and counts used by
+    # the explanation batch, the render loop and the statistics below,
+    # replacing repeated equality scans over the whole frame
+    tier_frames = {p: g for p, g in df.groupby('Priority_Level', sort=False)}
+    tier_counts = df['Priority_Level'].value_counts().to_dict()
+
+    # Only the two expanders that render open by default get their
+    # explanations generated up front (one packed call); every collapsed
+    # card defers its call to a button inside the fragment. Same
+    # community + same preferences means the same answer, so results are
+    # memoized in session_state and reruns cost zero OpenAI calls.
+    prefs_hash = hashlib.md5(
+        json.dumps(prefs, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+    def explanation_key(row_key, row):
+        return f"expl_{row.get('CommunityID', row_key)}_{prefs_hash}"
+
+    if api_key and api_key.startswith("sk-"):
+        eager = {
+            row_key: row
+            for row_key, row in tier_frames.get(1, df.iloc[:0]).head(2).iterrows()
+            if explanation_key(row_key, row) not in st.session_state
+        }
+        if eager:
+            with st.spinner("🤖 Generating match explanations..."):
+                fresh = generate_explanations(api_key, prefs, eager)
+            for row_key, row in eager.items():
+                text = fresh.get(str(row_key))
+                if text:
+                    st.session_state[explanation_key(row_key, row)] = text
+
     # Display communities grouped by priority
     for priority_level in [1, 2, 3]:
-        priority_communities = df[df['Priority_Level'] == priority_level]
-        
+        priority_communities = tier_frames.get(priority_level, df.iloc[:0])
+
         if len(priority_communities) == 0:
             continue
         
@@ -679,91 +1038,25 @@ elif st.session_state.step == "results":
         # Show top 5 from this priority level (or all if less than 5)
         display_count = min(5, len(priority_communities))
         
-        for idx, (_, row) in enumerate(priority_communities.head(display_count).iterrows(), 1):
-            # Create label with priority tier info
-            distance_text = f"{round(row['Distance_miles'], 1)} mi" if pd.notna(row.get('Distance_miles')) else "N/A"
-            expander_label = f"P{priority_level}-{idx}. {row.get('Type of Service', 'N/A')} | {distance_text} | {row.get('Town', 'N/A')}"
-            
-            with st.expander(expander_label, expanded=(priority_level == 1 and idx <= 2)):
-                col1, col2 = st.columns([2, 1])
-
-                with col1:
-                    st.markdown(f"### 📍 Location & Details")
-                    town_val = row.get('Town', 'N/A')
-                    state_val = row.get('State', 'N/A')
-                    st.write(f"**Town:** {town_val}, {state_val}")
-                    
-                    if pd.notna(row.get('Distance_miles')):
-                        st.write(f"**Distance:** {round(row['Distance_miles'], 1)} miles from preferred location")
-                    st.write(f"**Service Type:** {row.get('Type of Service', 'N/A')}")
-                    st.write(f"**Apartment Type:** {row.get('Apartment Type', 'N/A')}")
-
-                with col2:
-                    st.markdown(f"### 💰 Pricing")
-                    if pd.notna(row.get('Monthly Fee')):
-                        st.metric("Monthly Fee", f"${int(row['Monthly Fee']):,}")
-                    else:
-                        st.metric("Monthly Fee", "Contact for pricing")
-                    st.metric("Priority Tier", f"Level {int(row.get('Priority_Level', 0))}")
-                    st.metric("Rank in Tier", f"#{int(row.get('Rank_Within_Priority', 0))}")
-
-                # AI Explanation - Fixed version
-                if api_key and api_key.startswith("sk-"):
-                    try:
-                        client = OpenAI(api_key=api_key)
-
-                        prompt = f"""As a senior living placement advisor, explain in 2-3 concise sentences why this community is a good match for the client.
-
-Client Needs:
-- Care Level: {prefs.get('care_level', 'Not specified')}
-- Budget: ${prefs.get('max_budget', 'Not specified')}
-- Preferred Location: {prefs.get('preferred_location', 'Not specified')}
-- Special Requirements: Enhanced={prefs.get('enhanced', 'No')}, Enriched={prefs.get('enriched', 'No')}
-
-Community Details:
-- Type: {row.get('Type of Service', 'N/A')}
-- Location: {town_val}, {state_val}
-- Monthly Fee: ${row.get('Monthly Fee', 'N/A')}
-- Distance: {round(row.get('Distance_miles', 0), 1) if pd.notna(row.get('Distance_miles')) else 'N/A'} miles
-- Priority Level: {row.get('Priority_Level', 'N/A')} ({"Contracted rates" if row.get('Priority_Level') == 1 else "Placement partner" if row.get('Priority_Level') == 2 else "Other"})
-
-Focus on: care level match, location convenience, value proposition, and why this priority tier makes sense."""
-
-                        response = client.chat.completions.create(
-                            model="gpt-4o-mini",
-                            messages=[{"role": "user", "content": prompt}],
-                            temperature=0.5,
-                            max_tokens=200
-                        )
-
-                        explanation = response.choices[0].message.content
-                        st.info(f"**🎯 Why This Community Matches:** {explanation}")
-
-                    except Exception as e:
-                        st.warning(f"⚠️ Could not generate AI explanation: {str(e)}")
-                elif not api_key:
-                    st.info("💡 Enter your OpenAI API key in the sidebar to see AI-powered match explanations")
-
-                # More Details - NOT nested, just in the same expander
-                st.markdown("---")
-                st.markdown("#### 📋 Additional Details")
-                details_col1, details_col2 = st.columns(2)
-                with details_col1:
-                    st.write(f"**Enhanced:** {row.get('Enhanced', 'N/A')}")
-                    st.write(f"**Enriched:** {row.get('Enriched', 'N/A')}")
-                    st.write(f"**Contract Status:** {row.get('Contract (w rate)?', 'N/A')}")
-                with details_col2:
-                    st.write(f"**Works with Placement:** {row.get('Work with Placement?', 'N/A')}")
-                    st.write(f"**Est. Waitlist:** {row.get('Est. Waitlist Length', 'N/A')}")
-                    st.write(f"**Community ID:** {row.get('CommunityID', 'N/A')}")
+        for idx, (row_key, row) in enumerate(priority_communities.head(display_count).iterrows(), 1):
+            render_community(row, prefs, priority_level, idx, explanation_key(row_key, row))
         
         # Show "View More" button if there are more than 5 in this tier
         if len(priority_communities) > 5:
             with st.expander(f"📋 View All {len(priority_communities)} Priority {priority_level} Communities"):
                 display_cols = ['Type of Service', 'Town', 'State', 'Monthly Fee', 'Distance_miles', 'Rank_Within_Priority']
                 available_cols = [col for col in display_cols if col in priority_communities.columns]
+                # Slice server-side so the client renders one page of rows
+                # regardless of how large the tier is
+                page_size = st.selectbox("Rows per page", [20, 50, 100], key=f"ps_{priority_level}")
+                page = st.number_input(
+                    "Page", 1,
+                    max(1, math.ceil(len(priority_communities) / page_size)),
+                    key=f"pg_{priority_level}"
+                )
                 st.dataframe(
-                    priority_communities[available_cols],
+                    priority_communities[available_cols].iloc[(page - 1) * page_size:page * page_size],
+                    height=min(600, (page_size + 1) * 36),
                     use_container_width=True,
                     hide_index=True
                 )
@@ -778,12 +1071,12 @@ Focus on: care level match, location convenience, value proposition, and why thi
     
     with col1:
         # Download Priority 1 communities
-        priority1_df = df[df['Priority_Level'] == 1]
+        priority1_df = tier_frames.get(1, df.iloc[:0])
         if len(priority1_df) > 0:
             download_cols = [col for col in ['Type of Service', 'Town', 'State', 'Monthly Fee',
                                              'Distance_miles', 'Rank_Within_Priority', 'Apartment Type',
                                              'Enhanced', 'Enriched', 'CommunityID'] if col in priority1_df.columns]
-            csv_p1 = priority1_df[download_cols].to_csv(index=False)
+            csv_p1 = to_csv_bytes(priority1_df, tuple(download_cols))
             st.download_button(
                 label=f"🥇 Priority 1 ({len(priority1_df)} communities)",
                 data=csv_p1,
@@ -796,12 +1089,12 @@ Focus on: care level match, location convenience, value proposition, and why thi
 
     with col2:
         # Download Priority 2 communities
-        priority2_df = df[df['Priority_Level'] == 2]
+        priority2_df = tier_frames.get(2, df.iloc[:0])
         if len(priority2_df) > 0:
             download_cols = [col for col in ['Type of Service', 'Town', 'State', 'Monthly Fee',
                                              'Distance_miles', 'Rank_Within_Priority', 'Apartment Type',
                                              'Enhanced', 'Enriched', 'CommunityID'] if col in priority2_df.columns]
-            csv_p2 = priority2_df[download_cols].to_csv(index=False)
+            csv_p2 = to_csv_bytes(priority2_df, tuple(download_cols))
             st.download_button(
                 label=f"🥈 Priority 2 ({len(priority2_df)} communities)",
                 data=csv_p2,
@@ -814,7 +1107,7 @@ Focus on: care level match, location convenience, value proposition, and why thi
     
     with col3:
         # Download all results
-        csv_all = df.to_csv(index=False)
+        csv_all = to_csv_bytes(df)
         st.download_button(
             label=f"📊 All Results ({len(df)} total)",
             data=csv_all,
@@ -832,32 +1125,54 @@ Focus on: care level match, location convenience, value proposition, and why thi
     with col1:
         st.metric("Total Matches", len(df))
     with col2:
-        priority1_count = len(df[df['Priority_Level'] == 1])
+        priority1_count = tier_counts.get(1, 0)
         st.metric("Priority 1 (Contracted)", priority1_count)
     with col3:
-        priority2_count = len(df[df['Priority_Level'] == 2])
+        priority2_count = tier_counts.get(2, 0)
         st.metric("Priority 2 (Partners)", priority2_count)
     with col4:
-        priority3_count = len(df[df['Priority_Level'] == 3])
+        priority3_count = tier_counts.get(3, 0)
         st.metric("Priority 3 (Other)", priority3_count)
     
     # Detailed stats per priority
     st.markdown("#### 📊 Average Metrics by Priority Tier")
     
-    stats_data = []
-    for priority in [1, 2, 3]:
-        priority_df = df[df['Priority_Level'] == priority]
-        if len(priority_df) > 0:
-            avg_distance = priority_df['Distance_miles'].mean() if 'Distance_miles' in priority_df.columns else None
-            avg_fee = priority_df['Monthly Fee'].mean() if 'Monthly Fee' in priority_df.columns else None
-            
-            stats_data.append({
-                'Priority Tier': f"Level {priority}",
-                'Count': len(priority_df),
-                'Avg Distance (mi)': f"{avg_distance:.1f}" if pd.notna(avg_distance) else "N/A",
-                'Avg Monthly Fee': f"${int(avg_fee):,}" if pd.notna(avg_fee) else "N/A",
-                'Closest Community (mi)': f"{priority_df['Distance_miles'].min():.1f}" if pd.notna(priority_df['Distance_miles'].min()) else "N/A"
-            })
-    
+    # One grouped aggregation replaces the per-tier mean()/min() column
+    # scans; adding a tier or a metric stays a single pass over the frame
+    agg_spec = {'Count': ('Priority_Level', 'size')}
+    if 'Distance_miles' in df.columns:
+        agg_spec['Avg Distance'] = ('Distance_miles', 'mean')
+        agg_spec['Min Distance'] = ('Distance_miles', 'min')
+    if 'Monthly Fee' in df.columns:
+        agg_spec['Avg Fee'] = ('Monthly Fee', 'mean')
+    tier_stats = df.groupby('Priority_Level').agg(**agg_spec)
+
+    stats_data = [
+        {
+            'Priority Tier': f"Level {priority}",
+            'Count': int(row['Count']),
+            'Avg Distance (mi)': f"{row['Avg Distance']:.1f}" if pd.notna(row.get('Avg Distance')) else "N/A",
+            'Avg Monthly Fee': f"${int(row['Avg Fee']):,}" if pd.notna(row.get('Avg Fee')) else "N/A",
+            'Closest Community (mi)': f"{row['Min Distance']:.1f}" if pd.notna(row.get('Min Distance')) else "N/A",
+        }
+        for priority, row in tier_stats.iterrows()
+        if priority in (1, 2, 3)
+    ]
+
     if stats_data:
         st.table(pd.DataFrame(stats_data))
+
+
+# =======================================
+# STEP DISPATCH
+# =======================================
+# Only the active step's body runs; everything above is module setup,
+# cached resources, and the sidebar.
+_STEPS = {
+    "upload": step_upload,
+    "transcribe": step_transcribe,
+    "preferences": step_preferences,
+    "rank": step_rank,
+    "results": step_results,
+}
+_STEPS[st.session_state.step]()
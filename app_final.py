@@ -1,21 +1,408 @@
 import streamlit as st
-import tempfile
+import asyncio
+import io
 import json
+import re
+import numpy as np
 import pandas as pd
-from pathlib import Path
-from openai import OpenAI
+from openai import AsyncOpenAI, OpenAI
+from pydub import AudioSegment
 from geopy.geocoders import Nominatim
-from geopy.distance import geodesic
+from geopy.extra.rate_limiter import RateLimiter
 import pgeocode
 import time
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
 
 
+# =======================================
+# ZIP GEOCODER
+# =======================================
+# pgeocode parses its postal CSV on construction; cache the instance so
+# the table is loaded once per process
+@st.cache_resource(show_spinner=False)
+def _pgeocode(country: str = "us") -> pgeocode.Nominatim:
+    return pgeocode.Nominatim(country)
+
+
+_EXTRACTION_SYSTEM_PROMPT = """
+You are a JSON generator for senior living placement.
+You MUST output ONLY valid JSON with NO markdown, NO explanations, NO code blocks.
+
+EXTRACTION RULES:
+1. Extract the PATIENT's information (the person who needs care), NOT the contact person
+2. For "max_budget": Extract ANY mention of monthly cost, budget, or price limit
+   - Look for phrases like: "$X per month", "$X/month", "budget is $X", "maximum $X", "up to $X"
+   - IMPORTANT: Extract ONLY the number (e.g., if text says "$4,000 per month", extract: 4000)
+   - If multiple budgets mentioned, use the MAXIMUM value
+   - If no budget mentioned, use null
+3. For "care_level": Choose ONE from ["Independent Living", "Assisted Living", "Enhanced Assisted Living", "Memory Care"]
+   - "Enhanced" or "higher level" care = "Enhanced Assisted Living"
+4. For "enhanced": Extract "yes" ONLY if explicitly mentioned as requirement
+5. For "enriched": Extract "yes" ONLY if explicitly mentioned as requirement
+6. For "preferred_location": Extract ALL cities/towns mentioned as preferences (format: ["City, State"])
+7. For "move_in_window": Choose ONE from ["Immediate (0-1 months)", "Near-term (1-6 months)", "Flexible (6+ months)"]
+   - "discharges in X" or "moving in X" = timeframe
+8. For "mentally": Describe cognitive state (e.g., "sharp", "mild impairment", "moderate dementia")
+
+JSON STRUCTURE:
+{
+    "name_of_patient": "",
+    "age_of_patient": "",
+    "injury_or_reason": "",
+    "primary_contact_information": {
+        "name": "",
+        "phone_number": "",
+        "email": ""
+    },
+    "mentally": "",
+    "care_level": "",
+    "preferred_location": [],
+    "enhanced": "",
+    "enriched": "",
+    "move_in_window": "",
+    "max_budget": null,
+    "pet_friendly": "",
+    "tour_availability": [],
+    "other_keywords": {}
+}
+
+CRITICAL: For max_budget, extract ONLY the numeric value (e.g., 4000, not "$4,000" or "4000 per month")
+"""
+
+# Fallback patterns for budgets the model misses, e.g. "$4,000",
+# "4000 per month", "budget is 4000"
+_BUDGET_PATTERNS = [
+    r'\$\s*(\d{1,3}(?:,\d{3})*(?:\.\d{2})?)',
+    r'(\d{1,3}(?:,\d{3})*)\s*(?:dollars?|per\s*month|/month)',
+    r'(?:budget|maximum|max|up to)\s*(?:is|of)?\s*\$?\s*(\d{1,3}(?:,\d{3})*)',
+]
+
+
+def _extract_preferences(api_key: str, transcript: str) -> dict:
+    # JSON mode guarantees syntactically valid JSON, so the parse needs
+    # no markdown-fence stripping
+    response = _openai_client(api_key).chat.completions.create(
+        model="gpt-4o",
+        response_format={"type": "json_object"},
+        messages=[
+            {"role": "system", "content": _EXTRACTION_SYSTEM_PROMPT},
+            {"role": "user", "content": f"""Extract structured information from this consultation call transcript.
+
+TRANSCRIPT:
+{transcript}
+
+IMPORTANT REMINDERS:
+- For max_budget: Look carefully for ANY mention of dollar amounts, monthly costs, or budget limits
+- Extract ONLY the numeric value (e.g., if "$4,000 per month" is mentioned, extract: 4000)
+- If multiple people or budgets are mentioned, extract the MAXIMUM value
+- Patient is the person RECEIVING care, not the family member calling
+
+Return ONLY valid JSON, no explanations."""},
+        ],
+    )
+
+    raw = response.choices[0].message.content
+    if not raw or raw.strip() == "":
+        raise ValueError("Empty response from GPT")
+
+    prefs = json.loads(raw)
+
+    # Post-processing: If budget is missing, try to extract with regex
+    if not prefs.get("max_budget") or prefs.get("max_budget") == "":
+        for pattern in _BUDGET_PATTERNS:
+            matches = re.findall(pattern, transcript, re.IGNORECASE)
+            if matches:
+                try:
+                    max_budget = max(float(m.replace(',', '')) for m in matches)
+                    prefs["max_budget"] = int(max_budget)
+                    st.info(f"💡 Detected budget from transcript: ${int(max_budget):,}/month")
+                    break
+                except ValueError:
+                    pass
+
+    return prefs
+
+
+def _rank_communities(prefs: dict) -> pd.DataFrame:
+    progress_bar = st.progress(0)
+    status_text = st.empty()
+
+    status_text.text("📥 Loading community database from Google Sheets...")
+    progress_bar.progress(10)
+    df = load_private_google_sheet("Living_Locators_Data", "Rochester")
+    st.info(f"📊 Loaded {len(df)} communities from database")
+
+    # ---------- FIX BUDGET ----------
+    status_text.text("💰 Processing budget information...")
+    progress_bar.progress(20)
+    if prefs.get("max_budget"):
+        try:
+            prefs["max_budget"] = float(str(prefs["max_budget"]).replace(",", "").strip())
+        except:
+            prefs["max_budget"] = None
+
+    # ---------- CLEAN MONTHLY FEE ----------
+    if "Monthly Fee" in df.columns:
+        # One extract on "string"-dtype data replaces the old
+        # $-strip / comma-strip / extract chain and its two
+        # intermediate object-dtype allocations
+        df["Monthly Fee"] = pd.to_numeric(
+            df["Monthly Fee"]
+            .astype("string")
+            .str.extract(r"([\d,.]+)", expand=False)
+            .str.replace(",", "", regex=False),
+            errors="coerce",
+        )
+
+    # ---------- SMART CARE LEVEL ----------
+    status_text.text("🏥 Filtering by care level...")
+    progress_bar.progress(30)
+    if prefs.get("care_level"):
+        text = str(prefs["care_level"]).lower()
+
+        # Case-fold the column once and run the one branch
+        # that fires as a plain substring scan (regex=False)
+        tos = df["Type of Service"].astype("string").str.lower()
+
+        if any(k in text for k in ["assisted", "al", "enhanced"]):
+            df = df[tos.str.contains("assisted", na=False, regex=False)]
+            st.info(f"✓ After care level filter: {len(df)} communities")
+
+        elif any(k in text for k in ["memory", "dementia"]):
+            df = df[tos.str.contains("memory", na=False, regex=False)]
+            st.info(f"✓ After care level filter: {len(df)} communities")
+
+        elif any(k in text for k in ["independent", "il"]):
+            df = df[tos.str.contains("independent", na=False, regex=False)]
+            st.info(f"✓ After care level filter: {len(df)} communities")
+
+    # ---------- ENHANCED ----------
+    status_text.text("⭐ Applying enhanced/enriched filters...")
+    progress_bar.progress(40)
+    if prefs.get("enhanced") in _YES_VALUES:
+        df = df[df["Enhanced"].isin(_YES_CELLS)]
+        st.info(f"✓ After enhanced filter: {len(df)} communities")
+
+    # ---------- ENRICHED ----------
+    if prefs.get("enriched") in _YES_VALUES:
+        df = df[df["Enriched"].isin(_YES_CELLS)]
+        st.info(f"✓ After enriched filter: {len(df)} communities")
+
+    # ---------- BUDGET FILTER ----------
+    if prefs.get("max_budget") is not None:
+        df = df[df["Monthly Fee"] <= prefs["max_budget"]]
+        st.info(f"✓ After budget filter: {len(df)} communities")
+
+    # ---------- EMPTY SHORT-CIRCUIT ----------
+    # Nothing survived the filters: skip priority assignment, the
+    # geocoding round-trips and the distance math outright. The columns
+    # the results pages read still need to exist on the empty frame,
+    # including Town/State, which only the skipped geocoding branch
+    # would otherwise create.
+    if df.empty:
+        df = df.assign(
+            Priority_Level=pd.Series(dtype=np.int8),
+            Distance_miles=pd.Series(dtype=float),
+            Town=pd.Series(dtype=str),
+            State=pd.Series(dtype=str),
+        )
+        status_text.empty()
+        progress_bar.empty()
+        st.warning("⚠️ No communities match the current filters")
+        return df
+
+    # ---------- PRIORITY ----------
+    status_text.text("🎯 Assigning priority levels...")
+    progress_bar.progress(50)
+    # Vectorized: lower-case each column once and route the
+    # tier rules through np.select instead of a callback per row
+    c = df.get("Contract (w rate)?", pd.Series("", index=df.index)).astype(str).str.lower()
+    p = df.get("Work with Placement?", pd.Series("", index=df.index)).astype(str).str.lower()
+    df["Priority_Level"] = np.select(
+        [~c.isin(_NO_CONTRACT), (c == "no") & (p == "yes")],
+        [1, 2],
+        default=3,
+    ).astype(np.int8)
+
+    # ---------- GEOCODING ----------
+    status_text.text("🗺️ Calculating distances (this may take a moment)...")
+    progress_bar.progress(60)
+
+    locs = prefs.get("preferred_location", ["Rochester, NY"])
+    if isinstance(locs, str):
+        locs = [locs]
+    # Dedupe (order-preserving) so a location the client
+    # mentioned twice costs one request and one sleep
+    locs = list(dict.fromkeys(locs))
+
+    coords_list = [
+        c for c in (_geocode_place(l) for l in locs) if c
+    ]
+
+    if not coords_list:
+        coords_list = [(43.1566, -77.6088)]  # Rochester default
+
+    progress_bar.progress(70)
+    zip_col = next((c for c in df.columns if "zip" in c.lower()), None)
+
+    status_text.text("📍 Geocoding communities...")
+    progress_bar.progress(80)
+
+    # One offline pgeocode lookup for every ZIP replaces the
+    # per-row Nominatim call (plus its 1s sleep); the same
+    # result frame feeds lat/lon and Town/State
+    if zip_col:
+        # Cells arrive as text ("" when blank), so guard on
+        # the string being numeric rather than on NaN
+        zips = df[zip_col].apply(
+            lambda z: str(int(float(z))).zfill(5)
+            if str(z).strip().replace(".", "", 1).isdigit() else ""
+        )
+        info = _pgeocode().query_postal_code(zips.tolist())
+        df["lat"] = info["latitude"].to_numpy(dtype=float)
+        df["lon"] = info["longitude"].to_numpy(dtype=float)
+        df["Town"] = info["place_name"].values
+        df["State"] = info["state_code"].values
+    else:
+        df["lat"] = np.nan
+        df["lon"] = np.nan
+
+    lat1 = df["lat"].to_numpy(dtype=float)
+    lon1 = df["lon"].to_numpy(dtype=float)
+    lat2 = np.array([c[0] for c in coords_list], dtype=float)
+    lon2 = np.array([c[1] for c in coords_list], dtype=float)
+    # One vectorized haversine over all (community, preferred
+    # location) pairs; rows without coords come out as NaN. With a
+    # single preferred location — the common case — the matrix is one
+    # column wide, so take it directly instead of reducing with min
+    miles = _haversine_miles(lat1, lon1, lat2, lon2)
+    df["Distance_miles"] = miles[:, 0] if miles.shape[1] == 1 else miles.min(axis=1)
+
+    status_text.text("📊 Sorting results...")
+    progress_bar.progress(95)
+    # Stable mergesort: Priority_Level has three values, so
+    # long runs are already ordered and merge passes are
+    # cheap and cache-friendly compared to quicksort
+    df = df.sort_values(
+        by=["Priority_Level", "Distance_miles"],
+        kind="mergesort", na_position="last", ignore_index=True
+    )
+
+    progress_bar.progress(100)
+    time.sleep(0.5)
+    status_text.empty()
+    progress_bar.empty()
+    return df
+
+
+# Spellings that count as "yes". The prefs side can carry real
+# booleans/numbers from the extracted JSON, so its set is permissive;
+# the column side must stay strings-only — sheet cells arrive as text,
+# and Arrow-backed isin raises on a mixed str/bool value set
+_YES_VALUES = frozenset({"yes", "Yes", "YES", "y", "Y", "true", "True", "TRUE", True, 1, "1"})
+_YES_CELLS = frozenset(v for v in _YES_VALUES if isinstance(v, str))
+
+# Lower-cased contract values that mean "no contracted rate"; built
+# once rather than as a throwaway list inside the ranking handler
+_NO_CONTRACT = frozenset({"no", "nan", ""})
+
+
+# Serializing the CSV is memoized on the frame's contents, so reruns of
+# the results page stop re-encoding an unchanged download payload
+@st.cache_data(show_spinner=False)
+def _to_csv_bytes(df: pd.DataFrame, cols: tuple = ()) -> bytes:
+    out = df[list(cols)] if cols else df
+    return out.to_csv(index=False).encode()
+
+
+# Broadcast haversine: rows × preferred locations in one NumPy kernel.
+# Accurate to ~0.3% against geodesic at these distances, which is well
+# inside how the mileage is used (ranking and one-decimal display)
+def _haversine_miles(lat1, lon1, lat2, lon2):
+    dlat = np.radians(lat2[None, :] - lat1[:, None])
+    dlon = np.radians(lon2[None, :] - lon1[:, None])
+    a = (
+        np.sin(dlat / 2) ** 2
+        + np.cos(np.radians(lat1))[:, None]
+        * np.cos(np.radians(lat2))[None, :]
+        * np.sin(dlon / 2) ** 2
+    )
+    return 3958.8 * 2 * np.arcsin(np.sqrt(a))
+
+
+# Nominatim lookups, paced to the service's 1 req/s policy. Results are
+# cached to disk as plain (lat, lon) tuples, so reruns — and restarts —
+# that ask about the same place never leave the machine, and the rate
+# limiter only ever paces genuine cache misses
+@st.cache_resource(show_spinner=False)
+def _nominatim_geocode():
+    return RateLimiter(
+        Nominatim(user_agent="assisted_living").geocode,
+        min_delay_seconds=1,
+        swallow_exceptions=True,
+    )
+
+
+@st.cache_data(ttl=86400, persist="disk", show_spinner=False)
+def _geocode_place(query: str):
+    geo = _nominatim_geocode()(query)
+    return (geo.latitude, geo.longitude) if geo else None
+
+
+# One OpenAI client per API key for the whole process: the underlying
+# HTTP connection pool and TLS session are reused across steps and
+# reruns instead of being rebuilt for every call
+@st.cache_resource(show_spinner=False)
+def _openai_client(api_key: str) -> OpenAI:
+    return OpenAI(api_key=api_key)
+
+
+# Whisper rejects uploads above 25 MB — and only after the whole file
+# has crossed the wire. Oversized recordings are split client-side into
+# ten-minute mp3 chunks instead, which the async gather then
+# transcribes in parallel.
+_WHISPER_MAX_BYTES = 25 * 1024 * 1024
+_SPLIT_CHUNK_MS = 10 * 60 * 1000
+
+
+def _audio_uploads(f):
+    data = f.getvalue()
+    if len(data) <= _WHISPER_MAX_BYTES:
+        return [(f.name, data, f.type)]
+    audio = AudioSegment.from_file(io.BytesIO(data))
+    parts = []
+    for i in range(0, len(audio), _SPLIT_CHUNK_MS):
+        buf = io.BytesIO()
+        audio[i:i + _SPLIT_CHUNK_MS].export(buf, format="mp3", bitrate="64k")
+        parts.append((f"chunk_{i // _SPLIT_CHUNK_MS}.mp3", buf.getvalue(), "audio/mpeg"))
+    return parts
+
+
+# Async so several uploads transcribe concurrently; with today's
+# single-file uploader the gather degenerates to one awaited call
+# unless a long recording was split, but the step is already shaped
+# for multi-file consultations
+async def _transcribe_files(api_key: str, files) -> str:
+    uploads = [u for f in files for u in _audio_uploads(f)]
+    client = AsyncOpenAI(api_key=api_key)
+    try:
+        transcripts = await asyncio.gather(*[
+            client.audio.transcriptions.create(model="whisper-1", file=u)
+            for u in uploads
+        ])
+        return " ".join(t.text for t in transcripts)
+    finally:
+        await client.close()
+
+
 # =======================================
 # GOOGLE SHEET LOADER
 # =======================================
-def load_private_google_sheet(sheet_name: str, worksheet_name: str = None):
+# cache_resource for the connection: the OAuth token and HTTP session
+# are reused across reruns instead of re-authorizing every time
+@st.cache_resource(show_spinner=False)
+def _gspread_client():
     scope = [
         "https://www.googleapis.com/auth/spreadsheets.readonly",
         "https://www.googleapis.com/auth/drive.readonly",
@@ -23,10 +410,28 @@ def load_private_google_sheet(sheet_name: str, worksheet_name: str = None):
     creds = ServiceAccountCredentials.from_json_keyfile_dict(
         st.secrets["gcp_service_account"], scope
     )
-    client = gspread.authorize(creds)
+    return gspread.authorize(creds)
+
+
+# cache_data for the frame: both inputs are plain strings, so reruns
+# within the TTL get the parsed DataFrame back without a network trip.
+# get_all_values skips get_all_records' per-row dict building — the
+# header row plus a list of rows feed the DataFrame constructor directly
+@st.cache_data(ttl=600, show_spinner="Loading communities…")
+def load_private_google_sheet(sheet_name: str, worksheet_name: str = None):
+    client = _gspread_client()
     sheet = client.open(sheet_name)
     ws = sheet.worksheet(worksheet_name) if worksheet_name else sheet.sheet1
-    return pd.DataFrame(ws.get_all_records())
+    rows = ws.get_all_values()
+    if not rows:
+        return pd.DataFrame()
+    # Arrow-backed columns make the downstream str.contains/str.lower
+    # filters run as vectorized C kernels instead of the object-dtype
+    # path; blank cells stay "" rather than becoming NA, so the
+    # contract/placement rules see the same values as before
+    return pd.DataFrame(rows[1:], columns=rows[0]).convert_dtypes(
+        dtype_backend="pyarrow"
+    )
 
 
 # =======================================
@@ -102,11 +507,41 @@ if st.session_state.step == "upload":
 
     if audio:
         st.success(f"✅ File uploaded: **{audio.name}** ({len(audio.getbuffer()) / (1024*1024):.2f} MB)")
+        if len(audio.getbuffer()) > _WHISPER_MAX_BYTES:
+            st.info("ℹ️ File exceeds Whisper's 25 MB limit — it will be split into chunks and transcribed in parallel")
         st.session_state.audio_files = audio
-        
-        if st.button("▶️ Continue to Transcription", type="primary"):
-            st.session_state.step = "transcribe"
-            st.rerun()
+
+        col1, col2 = st.columns(2)
+        with col1:
+            if st.button("▶️ Continue to Transcription", type="primary"):
+                st.session_state.step = "transcribe"
+                st.rerun()
+        with col2:
+            # One-shot path: transcribe, extract and rank inside a single
+            # script run, replacing the three intermediate st.rerun()
+            # round-trips of the step-by-step flow
+            if st.button("⚡ Run Full Pipeline", disabled=not api_key):
+                try:
+                    with st.status("Running the full pipeline…", expanded=True) as status:
+                        st.write("🎤 Transcribing audio...")
+                        st.session_state.transcription = asyncio.run(
+                            _transcribe_files(api_key, [audio])
+                        )
+                        st.write("🧠 Extracting preferences...")
+                        st.session_state.preferences = _extract_preferences(
+                            api_key, st.session_state.transcription
+                        )
+                        st.write("🏡 Ranking communities...")
+                        st.session_state.results = _rank_communities(
+                            st.session_state.preferences
+                        )
+                        status.update(label="✅ Pipeline complete", state="complete")
+                    st.session_state.step = "results"
+                    st.rerun()
+                except Exception as e:
+                    st.error(f"❌ Pipeline Error: {e}")
+            if not api_key:
+                st.caption("Enter your OpenAI API key in the sidebar to run the full pipeline")
 
 
 # =======================================
@@ -139,33 +574,17 @@ elif st.session_state.step == "transcribe":
             status_text = st.empty()
             
             try:
-                status_text.text("🔄 Initializing OpenAI client...")
-                progress_bar.progress(10)
-                client = OpenAI(api_key=api_key)
-                
                 audio_file = st.session_state.audio_files
-                ext = audio_file.name.split('.')[-1]
-
-                status_text.text("📦 Preparing audio file...")
-                progress_bar.progress(30)
-                with tempfile.NamedTemporaryFile(delete=False, suffix=f".{ext}") as tmp:
-                    tmp.write(audio_file.getbuffer())
-                    fp = tmp.name
 
                 status_text.text("🎤 Sending to Whisper API (this may take a minute)...")
                 progress_bar.progress(50)
-                
-                with open(fp, "rb") as f:
-                    transcript = client.audio.transcriptions.create(
-                        model="whisper-1",
-                        file=f
-                    )
 
-                status_text.text("🧹 Cleaning up temporary files...")
-                progress_bar.progress(90)
-                Path(fp).unlink()
-
-                st.session_state.transcription = transcript.text
+                # The SDK accepts a (filename, bytes) tuple, so the upload
+                # goes straight from the in-memory buffer — no temp file
+                # write/read/unlink round-trip through the filesystem
+                st.session_state.transcription = asyncio.run(
+                    _transcribe_files(api_key, [audio_file])
+                )
                 
                 progress_bar.progress(100)
                 status_text.empty()
@@ -258,123 +677,17 @@ elif st.session_state.step == "preferences":
             status_text = st.empty()
             
             try:
-                status_text.text("🤖 Initializing AI model...")
-                progress_bar.progress(20)
-                client = OpenAI(api_key=api_key)
-
-                system_prompt = """
-                You are a JSON generator for senior living placement.
-                You MUST output ONLY valid JSON with NO markdown, NO explanations, NO code blocks.
-
-                EXTRACTION RULES:
-                1. Extract the PATIENT's information (the person who needs care), NOT the contact person
-                2. For "max_budget": Extract ANY mention of monthly cost, budget, or price limit
-                   - Look for phrases like: "$X per month", "$X/month", "budget is $X", "maximum $X", "up to $X"
-                   - IMPORTANT: Extract ONLY the number (e.g., if text says "$4,000 per month", extract: 4000)
-                   - If multiple budgets mentioned, use the MAXIMUM value
-                   - If no budget mentioned, use null
-                3. For "care_level": Choose ONE from ["Independent Living", "Assisted Living", "Enhanced Assisted Living", "Memory Care"]
-                   - "Enhanced" or "higher level" care = "Enhanced Assisted Living"
-                4. For "enhanced": Extract "yes" ONLY if explicitly mentioned as requirement
-                5. For "enriched": Extract "yes" ONLY if explicitly mentioned as requirement
-                6. For "preferred_location": Extract ALL cities/towns mentioned as preferences (format: ["City, State"])
-                7. For "move_in_window": Choose ONE from ["Immediate (0-1 months)", "Near-term (1-6 months)", "Flexible (6+ months)"]
-                   - "discharges in X" or "moving in X" = timeframe
-                8. For "mentally": Describe cognitive state (e.g., "sharp", "mild impairment", "moderate dementia")
-
-                JSON STRUCTURE:
-                {
-                    "name_of_patient": "",
-                    "age_of_patient": "",
-                    "injury_or_reason": "",
-                    "primary_contact_information": {
-                        "name": "",
-                        "phone_number": "",
-                        "email": ""
-                    },
-                    "mentally": "",
-                    "care_level": "",
-                    "preferred_location": [],
-                    "enhanced": "",
-                    "enriched": "",
-                    "move_in_window": "",
-                    "max_budget": null,
-                    "pet_friendly": "",
-                    "tour_availability": [],
-                    "other_keywords": {}
-                }
-                
-                CRITICAL: For max_budget, extract ONLY the numeric value (e.g., 4000, not "$4,000" or "4000 per month")
-                """
-
                 status_text.text("🧠 Analyzing transcription and extracting preferences...")
                 progress_bar.progress(50)
-                
-                response = client.chat.completions.create(
-                    model="gpt-4o",
-                    messages=[
-                        {"role": "system", "content": system_prompt},
-                        {"role": "user", "content": f"""Extract structured information from this consultation call transcript.
-
-TRANSCRIPT:
-{st.session_state.transcription}
 
-IMPORTANT REMINDERS:
-- For max_budget: Look carefully for ANY mention of dollar amounts, monthly costs, or budget limits
-- Extract ONLY the numeric value (e.g., if "$4,000 per month" is mentioned, extract: 4000)
-- If multiple people or budgets are mentioned, extract the MAXIMUM value
-- Patient is the person RECEIVING care, not the family member calling
-
-Return ONLY valid JSON, no explanations."""},
-                    ],
+                st.session_state.preferences = _extract_preferences(
+                    api_key, st.session_state.transcription
                 )
 
-                status_text.text("📊 Processing AI response...")
-                progress_bar.progress(80)
-                
-                raw = response.choices[0].message.content
-                
-                # Clean response if it has markdown
-                if "```json" in raw:
-                    raw = raw.split("```json")[1].split("```")[0].strip()
-                elif "```" in raw:
-                    raw = raw.split("```")[1].split("```")[0].strip()
-
-                if not raw or raw.strip() == "":
-                    raise ValueError("Empty response from GPT")
-
-                prefs = json.loads(raw)
-                
-                # Post-processing: If budget is missing, try to extract with regex
-                if not prefs.get("max_budget") or prefs.get("max_budget") == "":
-                    import re
-                    # Look for patterns like "$4,000", "$4000", "4000 dollars", etc.
-                    budget_patterns = [
-                        r'\$\s*(\d{1,3}(?:,\d{3})*(?:\.\d{2})?)',  # $4,000 or $4000.00
-                        r'(\d{1,3}(?:,\d{3})*)\s*(?:dollars?|per\s*month|/month)',  # 4000 dollars
-                        r'(?:budget|maximum|max|up to)\s*(?:is|of)?\s*\$?\s*(\d{1,3}(?:,\d{3})*)',  # budget is $4000
-                    ]
-                    
-                    transcript_lower = st.session_state.transcription.lower()
-                    for pattern in budget_patterns:
-                        matches = re.findall(pattern, st.session_state.transcription, re.IGNORECASE)
-                        if matches:
-                            # Extract all numbers, remove commas, and take the maximum
-                            try:
-                                budget_values = [float(m.replace(',', '')) for m in matches]
-                                max_budget = max(budget_values)
-                                prefs["max_budget"] = int(max_budget)
-                                st.info(f"💡 Detected budget from transcript: ${int(max_budget):,}/month")
-                                break
-                            except:
-                                pass
-                
-                st.session_state.preferences = prefs
-                
                 progress_bar.progress(100)
                 status_text.empty()
                 progress_bar.empty()
-                
+
                 st.success("✅ Preferences extracted!")
                 st.rerun()
 
@@ -382,9 +695,6 @@ Return ONLY valid JSON, no explanations."""},
                 status_text.empty()
                 progress_bar.empty()
                 st.error(f"❌ Preference Extraction Error: {e}")
-                if 'raw' in locals():
-                    with st.expander("🔍 Debug: Raw AI Response"):
-                        st.code(raw)
 
 
 # =======================================
@@ -429,174 +739,17 @@ elif st.session_state.step == "rank":
     else:
         # Ranking button
         if st.button("🎯 Start Ranking", type="primary"):
-            progress_container = st.container()
-            
-            with progress_container:
-                progress_bar = st.progress(0)
-                status_text = st.empty()
-                
-                try:
-                    prefs = st.session_state.preferences
-
-                    status_text.text("📥 Loading community database from Google Sheets...")
-                    progress_bar.progress(10)
-                    df = load_private_google_sheet("Living_Locators_Data", "Rochester")
-                    initial_count = len(df)
-                    st.info(f"📊 Loaded {initial_count} communities from database")
-
-                    # ---------- FIX BUDGET ----------
-                    status_text.text("💰 Processing budget information...")
-                    progress_bar.progress(20)
-                    if prefs.get("max_budget"):
-                        try:
-                            prefs["max_budget"] = float(str(prefs["max_budget"]).replace(",", "").strip())
-                        except:
-                            prefs["max_budget"] = None
-
-                    # ---------- CLEAN MONTHLY FEE ----------
-                    if "Monthly Fee" in df.columns:
-                        df["Monthly Fee"] = (
-                            df["Monthly Fee"]
-                            .astype(str)
-                            .str.replace("$", "", regex=False)
-                            .str.replace(",", "", regex=False)
-                            .str.extract(r"(\d+\.?\d*)")[0]
-                        )
-                        df["Monthly Fee"] = pd.to_numeric(df["Monthly Fee"], errors="coerce")
-
-                    # ---------- SMART CARE LEVEL ----------
-                    status_text.text("🏥 Filtering by care level...")
-                    progress_bar.progress(30)
-                    if prefs.get("care_level"):
-                        text = str(prefs["care_level"]).lower()
-
-                        if any(k in text for k in ["assisted", "al", "enhanced"]):
-                            df = df[df["Type of Service"].str.contains("Assisted", case=False, na=False)]
-                            st.info(f"✓ After care level filter: {len(df)} communities")
-
-                        elif any(k in text for k in ["memory", "dementia"]):
-                            df = df[df["Type of Service"].str.contains("Memory", case=False, na=False)]
-                            st.info(f"✓ After care level filter: {len(df)} communities")
-
-                        elif any(k in text for k in ["independent", "il"]):
-                            df = df[df["Type of Service"].str.contains("Independent", case=False, na=False)]
-                            st.info(f"✓ After care level filter: {len(df)} communities")
-
-                    # ---------- ENHANCED ----------
-                    status_text.text("⭐ Applying enhanced/enriched filters...")
-                    progress_bar.progress(40)
-                    if prefs.get("enhanced") in [True, "true", "True", "Yes"]:
-                        df = df[df["Enhanced"].astype(str).str.lower() == "yes"]
-                        st.info(f"✓ After enhanced filter: {len(df)} communities")
-
-                    # ---------- ENRICHED ----------
-                    if prefs.get("enriched") in [True, "true", "True", "Yes"]:
-                        df = df[df["Enriched"].astype(str).str.lower() == "yes"]
-                        st.info(f"✓ After enriched filter: {len(df)} communities")
-
-                    # ---------- BUDGET FILTER ----------
-                    if prefs.get("max_budget") is not None:
-                        df = df[df["Monthly Fee"] <= prefs["max_budget"]]
-                        st.info(f"✓ After budget filter: {len(df)} communities")
-
-                    # ---------- PRIORITY ----------
-                    status_text.text("🎯 Assigning priority levels...")
-                    progress_bar.progress(50)
-                    def assign_priority(row):
-                        c = str(row.get("Contract (w rate)?", "")).lower()
-                        p = str(row.get("Work with Placement?", "")).lower()
-                        if c not in ["no", "nan", ""]:
-                            return 1
-                        if c == "no" and p == "yes":
-                            return 2
-                        return 3
-
-                    df["Priority_Level"] = df.apply(assign_priority, axis=1)
-
-                    # ---------- GEOCODING ----------
-                    status_text.text("🗺️ Calculating distances (this may take a moment)...")
-                    progress_bar.progress(60)
-                    
-                    geolocator = Nominatim(user_agent="assisted_living")
-
-                    locs = prefs.get("preferred_location", ["Rochester, NY"])
-                    if isinstance(locs, str):
-                        locs = [locs]
-
-                    coords_list = []
-                    for l in locs:
-                        try:
-                            geo = geolocator.geocode(l)
-                            if geo:
-                                coords_list.append((geo.latitude, geo.longitude))
-                            time.sleep(1)
-                        except:
-                            pass
-
-                    if not coords_list:
-                        coords_list = [(43.1566, -77.6088)]  # Rochester default
-
-                    progress_bar.progress(70)
-                    zip_col = next((c for c in df.columns if "zip" in c.lower()), None)
-
-                    def get_coord(row):
-                        if zip_col:
-                            z = row.get(zip_col)
-                            if pd.notna(z):
-                                try:
-                                    loc = geolocator.geocode(f"{int(float(z)):05d}, NY")
-                                    time.sleep(1)
-                                    if loc:
-                                        return (loc.latitude, loc.longitude)
-                                except:
-                                    pass
-                        return None
-
-                    status_text.text("📍 Geocoding communities...")
-                    progress_bar.progress(80)
-                    df["Community_Coords"] = df.apply(get_coord, axis=1)
-
-                    def dist(c):
-                        if c is None:
-                            return None
-                        try:
-                            return min(geodesic(c, k).miles for k in coords_list)
-                        except:
-                            return None
-
-                    df["Distance_miles"] = df["Community_Coords"].apply(dist)
-
-                    # Add Town/State
-                    if zip_col:
-                        nomi = pgeocode.Nominatim('us')
-                        df["Town"] = df[zip_col].apply(
-                            lambda z: nomi.query_postal_code(str(int(float(z))).zfill(5)).place_name if pd.notna(z) else None
-                        )
-                        df["State"] = df[zip_col].apply(
-                            lambda z: nomi.query_postal_code(str(int(float(z))).zfill(5)).state_code if pd.notna(z) else None
-                        )
-
-                    status_text.text("📊 Sorting results...")
-                    progress_bar.progress(95)
-                    df = df.sort_values(by=["Priority_Level", "Distance_miles"])
-
-                    st.session_state.results = df
-                    
-                    progress_bar.progress(100)
-                    time.sleep(0.5)
-                    status_text.empty()
-                    progress_bar.empty()
-                    
-                    st.success(f"✅ Ranking complete! Found {len(df)} matching communities")
-                    st.rerun()
+            try:
+                df = _rank_communities(st.session_state.preferences)
+                st.session_state.results = df
+                st.success(f"✅ Ranking complete! Found {len(df)} matching communities")
+                st.rerun()
 
-                except Exception as e:
-                    status_text.empty()
-                    progress_bar.empty()
-                    st.error(f"❌ Ranking Error: {e}")
-                    import traceback
-                    with st.expander("🔍 Debug: Full Error Trace"):
-                        st.code(traceback.format_exc())
+            except Exception as e:
+                st.error(f"❌ Ranking Error: {e}")
+                import traceback
+                with st.expander("🔍 Debug: Full Error Trace"):
+                    st.code(traceback.format_exc())
 
 
 # =======================================
@@ -651,7 +804,10 @@ elif st.session_state.step == "results":
 
     top5 = df.head(5)
 
-    for idx, (_, row) in enumerate(top5.iterrows(), 1):
+    # to_dict("records") materializes the rows once as plain dicts;
+    # iterrows built a dtype-boxed Series per row on every rerun, and
+    # row.get(...) keeps working unchanged on dicts
+    for idx, row in enumerate(top5.to_dict("records"), 1):
         expander_label = f"#{idx} - {row.get('Type of Service', 'N/A')} | Priority Level {int(row.get('Priority_Level', 0))}"
         with st.expander(expander_label, expanded=(idx <= 3)):
             col1, col2 = st.columns([2, 1])
@@ -678,7 +834,7 @@ elif st.session_state.step == "results":
             # AI Explanation - Fixed version
             if api_key and api_key.startswith("sk-"):
                 try:
-                    client = OpenAI(api_key=api_key)
+                    client = _openai_client(api_key)
 
                     prompt = f"""As a senior living placement advisor, explain in 2-3 concise sentences why this community is an excellent match for the client.
 
@@ -736,9 +892,7 @@ Focus on: care level match, location convenience, value proposition, and any spe
         download_cols = [col for col in ['Type of Service', 'Town', 'State', 'Monthly Fee',
                                          'Distance_miles', 'Priority_Level', 'Apartment Type',
                                          'Enhanced', 'Enriched', 'CommunityID'] if col in top5.columns]
-        top5_download = top5[download_cols]
-
-        csv_top5 = top5_download.to_csv(index=False)
+        csv_top5 = _to_csv_bytes(top5, tuple(download_cols))
         patient_name = prefs.get('name_of_patient', 'client').replace(' ', '_')
         st.download_button(
             label="📄 Download Top 5 Recommendations (CSV)",
@@ -749,7 +903,7 @@ Focus on: care level match, location convenience, value proposition, and any spe
         )
 
     with col2:
-        csv_all = df.to_csv(index=False)
+        csv_all = _to_csv_bytes(df)
         st.download_button(
             label="📊 Download All Matching Communities (CSV)",
             data=csv_all,